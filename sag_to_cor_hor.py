@@ -1,19 +1,46 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 ## Convert sagittal sections to coronal and horizontal sections
 
 import os
 import re
 import sys
+import atexit
+import queue
 import string
 import random
 import socket
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import numpy as np
-import skimage
-from skimage import io
+import tifffile
+
+# Numba is optional: when present the slab gathers run as compiled,
+# parallel loops; otherwise the NumPy fallback below is used.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# The ahead-of-time compiled Cython kernels are optional too (build
+# with `python setup.py build_ext --inplace`). They are specialized for
+# uint16 stacks and take priority over the Numba kernels, which carry a
+# JIT warm-up and cannot assume the element size.
+try:
+    import xpose
+except ImportError:
+    xpose = None
+
+# CuPy is optional: with a GPU available the slab transposes run on the
+# device, whose memory bandwidth dwarfs the host's; only finished slabs
+# come back over the bus, and the host threads keep doing the encode.
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
 # Argument parsing
 description = '''
@@ -22,10 +49,12 @@ description = '''
 '''
 parser = argparse.ArgumentParser(description=description)
 direction_help = '''
-    Direction for the generated images. Possible values are 'AP', 'DV'.
+    Direction for the generated images. Possible values are 'AP', 'DV',
+    or 'BOTH' to generate both directions from a single pass over the
+    raw images.
 '''
-parser.add_argument('direction', metavar='DIRECTION', 
-                    action='store', choices=['AP', 'DV'], 
+parser.add_argument('direction', metavar='DIRECTION',
+                    action='store', choices=['AP', 'DV', 'BOTH'],
                     help=direction_help)
 starti_help = '''
     The start z index(inclusive, start with 0) in the direction of generated images, 
@@ -41,12 +70,19 @@ raw_path_help = "Path of raw TIFF images, with numbered filenames."
 parser.add_argument('-i', '--raw-path', help=raw_path_help, required=True)
 out_path_help = "Path for all the generated image outputs."
 parser.add_argument('-o', '--out-path', help=out_path_help, required=True)
+multipage_help = '''
+    Write one multi-page BigTIFF per direction (AP.tif / DV.tif) covering
+    the requested index range, instead of one file per section. Meant for
+    single full-range runs, not for batching.
+'''
+parser.add_argument('-m', '--multipage', action='store_true', help=multipage_help)
 
 args = parser.parse_args(sys.argv[1:])
 
 direction = args.direction
 starti = args.starti
 endi = args.endi
+multipage = args.multipage
 
 if starti > endi:
     starti, endi = endi, starti
@@ -57,8 +93,8 @@ if starti > endi:
 raw_path = args.raw_path
 out_path = args.out_path
 
-if not os.path.exists(out_path):
-    os.mkdir(out_path)
+# makedirs with exist_ok is a single race-free syscall, no stat first.
+os.makedirs(out_path, exist_ok=True)
 
 # Setup logging
 def generateId(size=6, chars=string.ascii_uppercase + string.digits):
@@ -73,8 +109,10 @@ logger.setLevel(logging.DEBUG)
 
 formatter = logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] %(message)s')
 
+# Per-section messages are logged at DEBUG, so the console only shows
+# the coarse INFO progress.
 ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
+ch.setLevel(logging.INFO)
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
@@ -82,32 +120,115 @@ hostname = socket.gethostname()
 fh = logging.FileHandler(os.path.join(out_path, '%s-%s-%s.log' % (hostname, __name__, generateId())))
 fh.setLevel(logging.DEBUG)
 fh.setFormatter(formatter)
-logger.addHandler(fh)
+
+# The log file keeps full detail, but its disk writes happen on a
+# background listener thread so they stay off the hot path.
+log_queue = queue.Queue(-1)
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, fh)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Compiled once; per-call re.search would redo the pattern-cache lookup
+# for every filename in the directory.
+tif_re = re.compile(r'\d+[.][tT][iI][fF]')
+serial_re = re.compile(r'(\d+)[.]')
 
 # Prepare sorted list of images
 logger.info('Getting and sorting list of TIFF images. Assumes as saggital sections.')
-img_list = [img for img in os.listdir(raw_path) if re.search(r'\d+[.][tT][iI][fF]', img)]
+# scandir enumerates and filters in one pass, and its DirEntry objects
+# carry the file type without an extra stat per name.
+with os.scandir(raw_path) as entries:
+    img_list = [e.name for e in entries if e.is_file() and tif_re.search(e.name)]
 
-def catchSerial(s):
-    serial = re.findall(r'(\d+)[.]', s)
-    if serial:
-        return int(serial[0])
-    return s
+# Decorate-sort-undecorate on the serial number, with one compiled
+# regex instead of a Python key function and re.findall per filename.
+decorated = [(int(serial_re.search(img).group(1)), img) for img in img_list]
+decorated.sort()
+img_list = [img for _, img in decorated]
 
-img_list.sort(key=catchSerial)
+# Joined paths are reused on the I/O path, so compute them once.
+img_paths = [os.path.join(raw_path, img) for img in img_list]
 
 # z: number of sagittal sections in total
 nz = len(img_list)
 
 # probe one single image for image dimensions and types
 logger.info('Probing one image for image dimensions and types')
-probe_fn = os.path.join(raw_path, img_list[0])
-probe_img = io.imread(probe_fn)
+probe_fn = img_paths[0]
+probe_img = tifffile.imread(probe_fn)
 
-# skimage reads image to (row, col), see also http://scikit-image.org/docs/stable/user_guide/numpy_images.html#coordinate-conventions
+# tifffile reads image to (row, col), same convention as skimage, see also http://scikit-image.org/docs/stable/user_guide/numpy_images.html#coordinate-conventions
 ny, nx = probe_img.shape
 data_type = probe_img.dtype
 
+def readRaw(img_raw_path):
+    try:
+        # For uncompressed, contiguously-stored TIFFs memmap gives a
+        # view straight over the file bytes, skipping the per-file
+        # decode and the extra array allocation of imread.
+        return tifffile.memmap(img_raw_path, mode='r')
+    except ValueError:
+        # Compressed or tiled files cannot be memory-mapped.
+        return tifffile.imread(img_raw_path)
+
+def availableMemory():
+    # Best-effort probe of free physical memory; None where the sysconf
+    # names are not provided (e.g. some non-Linux platforms).
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def completedSerials(section_path, prefix):
+    # One directory scan instead of a stat pair per candidate output;
+    # sections found here are skipped so interrupted runs resume.
+    done_re = re.compile(prefix + r'-(\d{5})[.]tif$')
+    done = set()
+    with os.scandir(section_path) as entries:
+        for entry in entries:
+            match = done_re.match(entry.name)
+            if match:
+                done.add(int(match.group(1)))
+    return done
+
+# Load the whole sagittal stack into memory once, so that re-slicing
+# works on in-memory views instead of re-reading every TIFF for every
+# generated section.
+vol_bytes = nz * ny * nx * data_type.itemsize
+mem_free = availableMemory()
+if mem_free is not None and vol_bytes > mem_free // 2:
+    # The stack does not comfortably fit in RAM (leave headroom for the
+    # gather slabs and the encoders). Leave the volume unset; the
+    # generators below then stream column bands straight out of the raw
+    # files instead, one pass over the files per output slab.
+    logger.info('Volume (%d bytes) exceeds free memory, '
+                'processing out of core in bands' % vol_bytes)
+    vol = None
+else:
+    logger.info('Loading %d sagittal sections into memory' % nz)
+    vol = np.empty((nz, ny, nx), dtype=data_type)
+    # The probe already decoded the first section; reuse it so every raw
+    # file is read exactly once.
+    # copyto skips the broadcasting and casting checks of fancy
+    # assignment; casting='equiv' still normalizes byte order but makes
+    # a file with a mismatched dtype fail loudly instead of being
+    # silently converted.
+    np.copyto(vol[0], probe_img, casting='equiv')
+    for i_raw, img_raw_path in enumerate(img_paths[1:], start=1):
+        np.copyto(vol[i_raw], readRaw(img_raw_path), casting='equiv')
+
+vol_gpu = None
+if cp is not None and vol is not None:
+    try:
+        # Upload the stack once; the per-slab transposes then run on
+        # the device.
+        vol_gpu = cp.asarray(vol)
+    except Exception:
+        # CuPy installed but no usable device (or the stack does not
+        # fit in GPU memory) - stay on the CPU paths.
+        logger.info('CuPy present but GPU unusable, staying on CPU')
+
 # Coronal sections, 'AP', anterior - posterior
 nx_AP, ny_AP, nz_AP = nz, ny, nx
 logger.info('Calculated dimensions for coronal(A-P) sections: x: %d, y: %d, and %d sections.' %
@@ -122,78 +243,208 @@ logger.info('Preparing output paths')
 out_path_AP = os.path.join(out_path, 'AP')
 out_path_DV = os.path.join(out_path, 'DV')
 
-if not os.path.exists(out_path_AP):
-    os.mkdir(out_path_AP)
+os.makedirs(out_path_AP, exist_ok=True)
+os.makedirs(out_path_DV, exist_ok=True)
 
-if not os.path.exists(out_path_DV):
-    os.mkdir(out_path_DV)
+if njit is not None:
+    # Compiled gathers remove the per-iteration Python dispatch and let
+    # LLVM vectorize the memcpy-like inner loop, with sections handled
+    # in parallel across cores.
+    @njit(parallel=True, cache=True)
+    def gatherAP(vol, b, slab):
+        # slab[j] = vol[:, :, b + j].T
+        for j in prange(slab.shape[0]):
+            for y in range(slab.shape[1]):
+                for z in range(slab.shape[2]):
+                    slab[j, y, z] = vol[z, y, b + j]
 
-def generateAP(iz):
-    logger.info('Generating AP image %d' % iz)
+    @njit(parallel=True, cache=True)
+    def gatherDV(vol, b, slab):
+        # slab[j] = vol[:, b + j, :]
+        for j in prange(slab.shape[0]):
+            for z in range(slab.shape[1]):
+                for x in range(slab.shape[2]):
+                    slab[j, z, x] = vol[z, b + j, x]
 
-    iz_path = os.path.join(out_path_AP, 'AP-%05d.tif' % iz)
-    if os.path.exists(iz_path) and os.path.isfile(iz_path):
-        img_AP_i = io.imread(iz_path)
-    else:
-        img_AP_i = np.zeros((ny_AP, nx_AP), dtype=data_type)
-    
-    for i_raw, img_raw_fn in enumerate(img_list):
-        img_raw_path = os.path.join(raw_path, img_raw_fn)
-        img_raw = io.imread(img_raw_path)
-        
-        logger.info('Re-adapting raw image %d to AP image %d' % (i_raw, iz))
-        # The result AP(coronal) image: (row 0, col 0) is top-left
-        #   row 0 -> ny_AP(raw ny): dorsal -> ventral
-        #   col 0 -> nx_AP(raw nz): lateral 0 (raw 0) -> lateral z (raw nz)
-        #   z   0 -> nz_AP(raw nx): anterior -> posterior
-        img_AP_i[:, i_raw] = img_raw[:, iz]
-    
-    logger.info('Writing AP image %d' % iz)
-    # compress with zlib when saving, ref:
-    # http://scikit-image.org/docs/dev/api/skimage.external.tifffile.html#skimage.external.tifffile.TiffWriter
-    io.imsave(iz_path, img_AP_i, compress=6)
-
-def generateDV(iz):    
-    logger.info('Generating DV image %d' % iz)
-
-    iz_path = os.path.join(out_path_DV, 'DV-%05d.tif' % iz)
-    if os.path.exists(iz_path) and os.path.isfile(iz_path):
-        img_DV_i = io.imread(iz_path)
-    else:
-        img_DV_i = np.zeros((ny_DV, nx_DV), dtype=data_type)
-    
-    for i_raw, img_raw_fn in enumerate(img_list):
-        img_raw_path = os.path.join(raw_path, img_raw_fn)
-        img_raw = io.imread(img_raw_path)
-        
-        logger.info('Re-adapting raw image %d to DV image %d' % (i_raw, iz))
-        # img_DV_i[ny_DV - i_raw - 1, :] = img_raw[iz, :]
-        # The result DV(horizontal) image: (row 0, col 0) is top-left
-        #   row 0 -> ny_DV(raw nz): lateral 0 (raw 0) -> lateral z (raw nz)
-        #   col 0 -> nx_DV(raw nx): anterior -> posterior
-        #   z   0 -> nz_DV(raw ny): dorsal -> ventral
-        img_DV_i[i_raw, :] = img_raw[iz, :]
-    
-    logger.info('Writing DV image %d' % iz)
-    # compress with zlib when saving, ref:
-    # http://scikit-image.org/docs/dev/DVi/skimage.external.tifffile.html#skimage.external.tifffile.TiffWriter
-    io.imsave(iz_path, img_DV_i, compress=6)
-
-if direction.upper() == 'AP':
-    if starti < 0:
-        starti = 0
-    if endi > nz_AP - 1:
-        endi = nz_AP - 1
-    logger.info('Generating re-sliced images AP(coronal), from %d to %d' % 
+def generateAP(starti, endi):
+    logger.info('Generating re-sliced images AP(coronal), from %d to %d' %
                 (starti, endi))
-    for i_AP in xrange(starti, endi + 1):
-        generateAP(i_AP)
-elif direction.upper() == 'DV':
-    if starti < 0:
-        starti = 0
-    if endi > nz_DV - 1:
-        endi = nz_DV - 1
+
+    # The result AP(coronal) image: (row 0, col 0) is top-left
+    #   row 0 -> ny_AP(raw ny): dorsal -> ventral
+    #   col 0 -> nx_AP(raw nz): lateral 0 (raw 0) -> lateral z (raw nz)
+    #   z   0 -> nz_AP(raw nx): anterior -> posterior
+    # Transposing (nz, ny, nx) -> (nx, ny, nz) makes each slab row the
+    # finished coronal section, so each output file is written exactly
+    # once.
+    def saveAP(i_AP, img_AP_i):
+        iz_path = os.path.join(out_path_AP, 'AP-%05d.tif' % i_AP)
+        # Lazy formatting: the message is only built if DEBUG is on.
+        logger.debug('Writing AP image %d', i_AP)
+        # Workers only encode their own contiguous slab row, no shared
+        # mutable state. zlib holds the GIL only briefly, so the deflate
+        # work of different slices overlaps across cores.
+        # zlib level 1 encodes several times faster than the default
+        # level 6 at a small ratio loss, which matters for a run that is
+        # mostly spent in deflate.
+        tifffile.imwrite(iz_path, img_AP_i,
+                         compression='zlib', compressionargs={'level': 1})
+
+    def gatherSlabAP(b, bend):
+        if vol is None:
+            # Out of core: one pass over the raw files per slab, copying
+            # only this slab's column band out of each section.
+            slab = np.empty((bend - b + 1, ny_AP, nx_AP), dtype=data_type)
+            for z, img_raw_path in enumerate(img_paths):
+                np.copyto(slab[:, :, z], readRaw(img_raw_path)[:, b:bend + 1].T,
+                          casting='equiv')
+        elif vol_gpu is not None:
+            # Tiled device transpose at GPU memory bandwidth; only the
+            # finished slab crosses back over the bus.
+            slab = cp.asnumpy(cp.ascontiguousarray(
+                vol_gpu[:, :, b:bend + 1].transpose(2, 1, 0)))
+        elif xpose is not None and vol.dtype == np.uint16:
+            slab = np.empty((bend - b + 1, ny_AP, nx_AP), dtype=vol.dtype)
+            xpose.gather_ap_u16(vol, b, slab)
+        elif njit is not None:
+            slab = np.empty((bend - b + 1, ny_AP, nx_AP), dtype=vol.dtype)
+            gatherAP(vol, b, slab)
+        else:
+            # One C-level blocked copy for the whole slab instead of a
+            # Python loop of per-section strided assignments. The result
+            # is C-contiguous, so each row goes to the encoder in its
+            # fast layout.
+            slab = np.ascontiguousarray(vol[:, :, b:bend + 1].transpose(2, 1, 0))
+        return slab
+
+    # Gather sections in slabs of ~8 MB so the strided reads out of vol
+    # stay cache-friendly and peak memory is bounded by one slab instead
+    # of the whole transposed volume. Out of core, larger slabs are
+    # worth the memory: each slab costs a full pass over the raw files.
+    # A quarter of free memory relies on the save loop keeping at most
+    # two slabs in flight, so the pair stays within half of it.
+    if vol is None:
+        slab_bytes = max(8 * 1024 * 1024, mem_free // 4)
+    else:
+        slab_bytes = 8 * 1024 * 1024
+    slab_size = max(1, slab_bytes // (ny_AP * nx_AP * data_type.itemsize))
+
+    if multipage:
+        # A single multi-page BigTIFF amortizes the per-file open,
+        # header and close costs over all sections and lets libtiff
+        # stream-compress the pages back to back.
+        tif_path = os.path.join(out_path_AP, 'AP.tif')
+        with tifffile.TiffWriter(tif_path, bigtiff=True) as writer:
+            for b in range(starti, endi + 1, slab_size):
+                bend = min(b + slab_size - 1, endi)
+                slab = gatherSlabAP(b, bend)
+                for j in range(bend - b + 1):
+                    logger.debug('Writing AP page %d', b + j)
+                    writer.write(slab[j], compression='zlib',
+                                 compressionargs={'level': 1})
+        return
+
+    done = completedSerials(out_path_AP, 'AP')
+    if done:
+        logger.info('Skipping %d AP images already present' % len(done))
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for b in range(starti, endi + 1, slab_size):
+            bend = min(b + slab_size - 1, endi)
+            if all(i in done for i in range(b, bend + 1)):
+                continue
+            slab = gatherSlabAP(b, bend)
+            # Drain the previous slab's encodes before queueing this
+            # one, so at most two slabs are in flight (one encoding,
+            # one just gathered). Unbounded submission lets finished
+            # slabs pile up behind the slower deflate workers until the
+            # whole transposed volume is resident again.
+            for future in futures:
+                future.result()
+            futures = [executor.submit(saveAP, b + j, slab[j])
+                       for j in range(bend - b + 1) if b + j not in done]
+        for future in futures:
+            future.result()
+
+def generateDV(starti, endi):
     logger.info('Generating re-sliced images DV(horizontal), from %d to %d' %
                 (starti, endi))
-    for i_DV in xrange(starti, endi + 1):
-        generateDV(i_DV)
+
+    # The result DV(horizontal) image: (row 0, col 0) is top-left
+    #   row 0 -> ny_DV(raw nz): lateral 0 (raw 0) -> lateral z (raw nz)
+    #   col 0 -> nx_DV(raw nx): anterior -> posterior
+    #   z   0 -> nz_DV(raw ny): dorsal -> ventral
+    # Transposing (nz, ny, nx) -> (ny, nz, nx) makes each slab row the
+    # finished horizontal section, so each output file is written
+    # exactly once.
+    def saveDV(i_DV, img_DV_i):
+        iz_path = os.path.join(out_path_DV, 'DV-%05d.tif' % i_DV)
+        logger.debug('Writing DV image %d', i_DV)
+        tifffile.imwrite(iz_path, img_DV_i,
+                         compression='zlib', compressionargs={'level': 1})
+
+    def gatherSlabDV(b, bend):
+        if vol is None:
+            # Out of core: one pass over the raw files per slab, copying
+            # only this slab's row band out of each section.
+            slab = np.empty((bend - b + 1, ny_DV, nx_DV), dtype=data_type)
+            for z, img_raw_path in enumerate(img_paths):
+                np.copyto(slab[:, z, :], readRaw(img_raw_path)[b:bend + 1, :],
+                          casting='equiv')
+        elif vol_gpu is not None:
+            slab = cp.asnumpy(cp.ascontiguousarray(
+                vol_gpu[:, b:bend + 1, :].transpose(1, 0, 2)))
+        elif xpose is not None and vol.dtype == np.uint16:
+            slab = np.empty((bend - b + 1, ny_DV, nx_DV), dtype=vol.dtype)
+            xpose.gather_dv_u16(vol, b, slab)
+        elif njit is not None:
+            slab = np.empty((bend - b + 1, ny_DV, nx_DV), dtype=vol.dtype)
+            gatherDV(vol, b, slab)
+        else:
+            slab = np.ascontiguousarray(vol[:, b:bend + 1, :].transpose(1, 0, 2))
+        return slab
+
+    # Same sizing trade-off as in generateAP, including the two-slab
+    # in-flight bound that makes mem_free // 4 safe.
+    if vol is None:
+        slab_bytes = max(8 * 1024 * 1024, mem_free // 4)
+    else:
+        slab_bytes = 8 * 1024 * 1024
+    slab_size = max(1, slab_bytes // (ny_DV * nx_DV * data_type.itemsize))
+
+    if multipage:
+        tif_path = os.path.join(out_path_DV, 'DV.tif')
+        with tifffile.TiffWriter(tif_path, bigtiff=True) as writer:
+            for b in range(starti, endi + 1, slab_size):
+                bend = min(b + slab_size - 1, endi)
+                slab = gatherSlabDV(b, bend)
+                for j in range(bend - b + 1):
+                    logger.debug('Writing DV page %d', b + j)
+                    writer.write(slab[j], compression='zlib',
+                                 compressionargs={'level': 1})
+        return
+
+    done = completedSerials(out_path_DV, 'DV')
+    if done:
+        logger.info('Skipping %d DV images already present' % len(done))
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for b in range(starti, endi + 1, slab_size):
+            bend = min(b + slab_size - 1, endi)
+            if all(i in done for i in range(b, bend + 1)):
+                continue
+            slab = gatherSlabDV(b, bend)
+            # At most two slabs in flight, as in generateAP.
+            for future in futures:
+                future.result()
+            futures = [executor.submit(saveDV, b + j, slab[j])
+                       for j in range(bend - b + 1) if b + j not in done]
+        for future in futures:
+            future.result()
+
+if direction.upper() in ('AP', 'BOTH'):
+    generateAP(max(starti, 0), min(endi, nz_AP - 1))
+if direction.upper() in ('DV', 'BOTH'):
+    generateDV(max(starti, 0), min(endi, nz_DV - 1))
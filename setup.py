@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+## Builds the optional Cython gather kernels used by sag_to_cor_hor.py:
+##     python setup.py build_ext --inplace
+
+from setuptools import Extension, setup
+from Cython.Build import cythonize
+
+extensions = [
+    Extension(
+        'xpose',
+        ['xpose.pyx'],
+        extra_compile_args=['-fopenmp'],
+        extra_link_args=['-fopenmp'],
+    ),
+]
+
+setup(name='image3d-xpose', ext_modules=cythonize(extensions))
@@ -0,0 +1,47 @@
+# cython: boundscheck=False, wraparound=False, language_level=3
+## Cache-blocked gather kernels for sag_to_cor_hor.py, specialized for
+## uint16 volumes (the common case for microscopy stacks). Optional;
+## build in place with:
+##
+##     python setup.py build_ext --inplace
+##
+## With the element size and layout known at compile time the inner
+## loops reduce to wide vector copies, and the 32x32 tiling keeps each
+## tile of the strided AP gather inside L1.
+
+from cython.parallel cimport prange
+from libc.stdint cimport uint16_t
+
+DEF BS = 32
+
+
+def gather_ap_u16(const uint16_t[:, :, ::1] vol, Py_ssize_t b,
+                  uint16_t[:, :, ::1] slab):
+    """slab[j, y, z] = vol[z, y, b + j], tiled over (j, z)."""
+    cdef Py_ssize_t nj = slab.shape[0]
+    cdef Py_ssize_t ny = slab.shape[1]
+    cdef Py_ssize_t nz = slab.shape[2]
+    cdef Py_ssize_t jj, zz, j, y, z, jmax, zmax
+    with nogil:
+        for jj in prange(0, nj, BS, schedule='static'):
+            jmax = jj + BS if jj + BS < nj else nj
+            for zz in range(0, nz, BS):
+                zmax = zz + BS if zz + BS < nz else nz
+                for j in range(jj, jmax):
+                    for y in range(ny):
+                        for z in range(zz, zmax):
+                            slab[j, y, z] = vol[z, y, b + j]
+
+
+def gather_dv_u16(const uint16_t[:, :, ::1] vol, Py_ssize_t b,
+                  uint16_t[:, :, ::1] slab):
+    """slab[j, z, x] = vol[z, b + j, x] -- contiguous row copies."""
+    cdef Py_ssize_t nj = slab.shape[0]
+    cdef Py_ssize_t nz = slab.shape[1]
+    cdef Py_ssize_t nx = slab.shape[2]
+    cdef Py_ssize_t j, z, x
+    with nogil:
+        for j in prange(nj, schedule='static'):
+            for z in range(nz):
+                for x in range(nx):
+                    slab[j, z, x] = vol[z, b + j, x]